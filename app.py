@@ -1,16 +1,20 @@
-import os, socket
-from transformers import pipeline, AutoTokenizer
-import socket
+import bootstrap  # sets the thread budget before torch is imported
+import os, socket, threading
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
-from rag_pipeline import PDFLoader, TextChunker, EmbeddingGenerator, VectorStore, RAGPipeline
 
 CONFIG = {
     "host": "0.0.0.0",
     "start_port": 5000,
+    "sticky_port": True,  # prefer start_port..start_port+max_port_attempts over any free port
     "max_port_attempts": 20,
     "pdf_path": "document.pdf",
+    "cache_root": ".rag_cache",
     "static_folder": "static",
+    "batching": {
+        "max_batch": 8,     # requests coalesced into one generate() call; 1 gives batch-independent answers
+        "max_wait": 0.015   # seconds to wait for more requests to join a batch
+    },
     "generation_config": {
         "max_new_tokens": 150,  # Changed from max_length
         "do_sample": False,
@@ -27,29 +31,45 @@ def initialize_components():
     try:
         print("Initializing RAG pipeline...")
         
-        loader = PDFLoader(CONFIG["pdf_path"])
-        text = loader.load()
-        if not text.strip():
-            raise ValueError("Extracted text is empty - check PDF content")
-            
-        chunker = TextChunker()
-        chunks = chunker.chunk(text)
-        print(f"Loaded {len(chunks)} text chunks from PDF")
+        # Deferred so the server starts, and serves static files, without loading torch
+        bootstrap.configure_torch()
+        from transformers import AutoTokenizer
+        from rag_pipeline import PDFLoader, TextChunker, EmbeddingGenerator, VectorStore, RAGPipeline, GenerationBatcher, index_cache_dir
         
+        chunker = TextChunker()
         tokenizer = AutoTokenizer.from_pretrained("gpt2")
         embedder = EmbeddingGenerator()
-        embeddings = embedder.generate(chunks)
-
         vector_store = VectorStore(tokenizer=tokenizer)  
-        vector_store.store(embeddings, chunks)
+        
+        cache_dir = index_cache_dir(
+            CONFIG["pdf_path"], chunker.chunk_size, chunker.overlap, embedder.model_name, VectorStore.CACHE_VERSION,
+            root=CONFIG["cache_root"]
+        )
+        if vector_store.load(cache_dir):
+            chunks = vector_store.texts
+            print(f"Loaded {len(chunks)} indexed chunks from {cache_dir}")
+        else:
+            loader = PDFLoader(CONFIG["pdf_path"])
+            text = loader.load()
+            if not text.strip():
+                raise ValueError("Extracted text is empty - check PDF content")
+            
+            chunks = chunker.chunk(text)
+            print(f"Loaded {len(chunks)} text chunks from PDF")
+            
+            embeddings = embedder.generate(chunks)
+            vector_store.store(embeddings, chunks)
+            vector_store.save(cache_dir)
 
         rag = RAGPipeline(generation_config=CONFIG["generation_config"])
+        batcher = GenerationBatcher(rag, **CONFIG["batching"])
         print("RAG pipeline initialized successfully")
         
         return {
             "vector_store": vector_store,
             "embedder": embedder,
             "rag": rag,
+            "batcher": batcher,
             "status": "ready",
             "chunks": chunks
         }
@@ -61,10 +81,36 @@ def initialize_components():
             "message": str(e)
         }
 
-components = initialize_components()
+_components = None
+_components_lock = threading.Lock()
+
+def get_components():
+    """Initializes the models on first use; concurrent first requests wait for one load.
+    Failed loads are not kept, so the next request retries instead of the worker staying down."""
+    global _components
+    if _components is None:
+        with _components_lock:
+            if _components is None:
+                components = initialize_components()
+                if components["status"] != "ready":
+                    return components
+                _components = components
+    return _components
+
+@app.route('/healthz')
+def health_check():
+    """Readiness probe; the first call does the model load, so it doubles as a warm-up hook"""
+    components = get_components()
+    if components["status"] != "ready":
+        return jsonify({
+            "status": components["status"],
+            "details": components.get("message")
+        }), 503
+    return jsonify({"status": "ready"})
 
 @app.route('/api/ask', methods=['POST'])
 def handle_query():
+    components = get_components()
     if components["status"] != "ready":
         return jsonify({
             "error": "System not ready",
@@ -81,14 +127,13 @@ def handle_query():
         
         query_embedding = components["embedder"].generate([question])[0]
         
-        relevant_chunks = components["vector_store"].search(query_embedding)
-        context = "\n".join(relevant_chunks)
+        hits = components["vector_store"].search(query_embedding, with_token_ids=True)
         
         try:
-            response = components["rag"].generate_response(question, context)
+            response = components["batcher"].submit(question, [ids for _, ids in hits]).result()
             return jsonify({
                 "answer": response,
-                "context": relevant_chunks
+                "context": [chunk for chunk, _ in hits]
             })
         except Exception as e:
             print(f"Generation error: {str(e)}")
@@ -113,14 +158,19 @@ def static_files(filename):
     return send_from_directory(CONFIG["static_folder"], filename)
 
 def find_available_port():
-    for port in range(CONFIG["start_port"], CONFIG["start_port"] + CONFIG["max_port_attempts"]):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.bind((CONFIG["host"], port))
-                return port
-        except OSError:
-            continue
-    raise RuntimeError(f"No available ports found")
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if CONFIG["sticky_port"]:
+            # A failed bind leaves the socket unbound, so one socket serves every probe
+            for port in range(CONFIG["start_port"], CONFIG["start_port"] + CONFIG["max_port_attempts"]):
+                try:
+                    s.bind((CONFIG["host"], port))
+                    return port
+                except OSError:
+                    continue
+        # Port 0 lets the kernel pick any free port in a single call
+        s.bind((CONFIG["host"], 0))
+        return s.getsockname()[1]
 
 if __name__ == '__main__':
     port = find_available_port()
@@ -0,0 +1,17 @@
+"""CPU thread budget shared by the embedding model and GPT-2.
+
+Import this before anything that imports torch: OpenMP reads OMP_NUM_THREADS
+only once, when the runtime is first loaded.
+"""
+import os, functools
+
+NUM_THREADS = int(os.environ.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // 2))))
+os.environ.setdefault("MKL_NUM_THREADS", str(NUM_THREADS))
+
+@functools.cache
+def configure_torch():
+    """Applies the budget to torch before either model runs. Cached because torch accepts
+    set_num_interop_threads only once per process, and initialization may be retried."""
+    import torch
+    torch.set_num_threads(NUM_THREADS)
+    torch.set_num_interop_threads(1)
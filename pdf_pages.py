@@ -0,0 +1,14 @@
+"""Per-page PDF text extraction for PDFLoader's process pool.
+
+Kept apart from rag_pipeline so that spawned workers, which import the module
+holding the target function, only load pypdfium2 and not torch.
+"""
+import pypdfium2
+
+def extract_page(file_path, index):
+    """Extracts the text of one page; opens its own document so it can run in any process"""
+    pdf = pypdfium2.PdfDocument(file_path)
+    try:
+        return pdf[index].get_textpage().get_text_range()
+    finally:
+        pdf.close()
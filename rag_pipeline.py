@@ -1,21 +1,62 @@
-import os, PyPDF2
+import os, re, json, time, queue, shutil, hashlib, tempfile, functools, threading, multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+import pypdfium2
+from pdf_pages import extract_page
 from sentence_transformers import SentenceTransformer
-from sklearn.neighbors import NearestNeighbors
+import faiss
 import numpy as np
-from transformers import pipeline, AutoTokenizer
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+try:
+    from optimum.onnxruntime import ORTModelForCausalLM, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+except ImportError:  # int8 CPU decoding is optional
+    ORTModelForCausalLM = None
+
+def tokenize_text(tokenizer, texts):
+    """Token IDs for texts that follow a prompt piece, with the separating space
+    that the fixed prompt pieces leave off"""
+    return tokenizer([" " + text for text in texts]).input_ids
+
+def index_cache_dir(pdf_path, *config, root=".rag_cache"):
+    """Cache directory for an index built from this PDF's bytes and the given pipeline settings"""
+    digest = hashlib.sha256()
+    with open(pdf_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(repr(config).encode())
+    return os.path.join(root, digest.hexdigest()[:16])
 
 class PDFLoader:
-    def __init__(self, file_path):
+    def __init__(self, file_path, pages_per_worker=32):
         self.file_path = file_path
+        # Each spawned worker costs a fresh interpreter, an import and a PDF open (~0.1-0.2 s),
+        # against a few ms of extraction per page, so it must have enough pages to pay for itself
+        self.pages_per_worker = pages_per_worker
 
     def load(self):
         if not os.path.exists(self.file_path):
             raise FileNotFoundError(f"PDF file not found at {self.file_path}")
         try:
-            with open(self.file_path, 'rb') as file:
-                reader = PyPDF2.PdfReader(file)
-                text = " ".join([page.extract_text() for page in reader.pages])
-                return text
+            pdf = pypdfium2.PdfDocument(self.file_path)
+            try:
+                n_pages = len(pdf)
+                workers = min(os.cpu_count() or 1, n_pages // self.pages_per_worker)
+                if workers < 2:
+                    return " ".join(page.get_textpage().get_text_range() for page in pdf)
+            finally:
+                pdf.close()
+            
+            # spawn, not fork: the caller may be a threaded server that has already loaded torch
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                texts = executor.map(
+                    functools.partial(extract_page, self.file_path),
+                    range(n_pages),
+                    chunksize=max(1, n_pages // (workers * 4))
+                )
+                return " ".join(texts)
         except Exception as e:
             raise RuntimeError(f"Failed to load PDF: {str(e)}")
 
@@ -27,24 +68,47 @@ class TextChunker:
     def chunk(self, text):
         if not text:
             raise ValueError("Input text cannot be empty")
-        words = text.split()
-        chunks = []
-        for i in range(0, len(words), self.chunk_size - self.overlap):
-            chunk = ' '.join(words[i:i + self.chunk_size])
-            chunks.append(chunk)
-        return chunks
+        # Character span of every word, so each chunk is one slice of the original text
+        spans = np.array([m.span() for m in re.finditer(r"\S+", text)], dtype=np.int64).reshape(-1, 2)
+        n_words = len(spans)
+        first = np.arange(0, n_words, self.chunk_size - self.overlap)
+        last = np.minimum(first + self.chunk_size, n_words) - 1
+        return [text[s:e] for s, e in zip(spans[first, 0].tolist(), spans[last, 1].tolist())]
 
 class EmbeddingGenerator:
-    def __init__(self, model_name='all-MiniLM-L6-v2'):
+    def __init__(self, model_name='all-MiniLM-L6-v2', batch_size=64):
+        self.model_name = model_name
         self.model = SentenceTransformer(model_name)
+        if torch.cuda.is_available():
+            self.model = self.model.half()
+        self.encode_config = {
+            "batch_size": batch_size,
+            "normalize_embeddings": True,
+            "convert_to_numpy": True,
+            "show_progress_bar": False
+        }
 
     def generate(self, texts):
         if not texts:
             raise ValueError("Input texts cannot be empty")
-        return self.model.encode(texts)
+        if len(texts) == 1:
+            # Single texts are queries; repeated questions hit the cache
+            return np.stack([self._encode_one(self._normalize(texts[0]))])
+        # encode() already length-sorts each batch internally to minimise padding
+        return self.model.encode(texts, **self.encode_config)
+
+    @staticmethod
+    def _normalize(text):
+        return re.sub(r"\s+", " ", text.strip().lower())
+
+    @functools.lru_cache(maxsize=1024)
+    def _encode_one(self, text_norm):
+        return self.model.encode([text_norm], **self.encode_config)[0]
 
 class RAGPipeline:
-    def __init__(self, model_name="gpt2", generation_config=None):
+    FALLBACK_ANSWER = "I couldn't generate a response. Please try a more specific question."
+
+    def __init__(self, model_name="gpt2", generation_config=None, quantize=True):
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         self.tokenizer.pad_token = self.tokenizer.eos_token
         
@@ -62,80 +126,285 @@ class RAGPipeline:
         
         if not self.generation_config.get("do_sample", False):
             self.generation_config.pop("temperature", None)
+        # truncation is a pipeline option; build_input_ids enforces the length budget itself
+        self.generation_config.pop("truncation", None)
         
-        self.generator = pipeline(
-            "text-generation",
-            model=model_name,
-            tokenizer=self.tokenizer,
-            device=-1
-        )
         self.max_model_length = 1024  # GPT-2's limit
-
-    def generate_response(self, query, context):
-
-        prompt = (
+        # The fixed parts of the prompt are tokenized once, chunks and queries arrive as token IDs.
+        # GPT-2's BPE folds a word's leading space into its token, so the fixed parts end without
+        # one and chunks and queries are tokenized as " " + text (see tokenize_text). Chunks after
+        # the first therefore follow the newline separator as "\n chunk" rather than "\nchunk".
+        self.prompt_prefix_ids = self._encode(
             "Answer the question based on the context below. "
             "If you don't know the answer, say 'I don't know'.\n\n"
-            f"Context: {context}\n\n"
-            f"Question: {query}\n"
-            "Answer:"
+            "Context:"
         )
+        self.separator_ids = self._encode("\n")
+        self.prompt_suffix_ids = self._encode("\n\nQuestion:")
+        self.answer_ids = self._encode("\nAnswer:")
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        if self.device == "cpu" and quantize and ORTModelForCausalLM is not None:
+            self.model = self._load_int8_model(model_name)
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(model_name).to(self.device)
+            self.model.eval()
+        
+        if self.device == "cuda" and getattr(self.model, "_supports_static_cache", False):
+            # Pre-allocated KV cache keeps tensor shapes fixed so the decode step compiles once
+            self.model.generation_config.cache_implementation = "static"
+            self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead", fullgraph=True)
+            self._warmup()
+
+    @staticmethod
+    def _load_int8_model(model_name, save_dir=None):
+        """Loads an int8 ONNX Runtime export of the model, quantizing it on first use"""
+        save_dir = save_dir or f"{model_name}-int8"
+        model_file = "model_quantized.onnx"  # written last by the quantizer, so it marks a finished export
+        if not os.path.exists(os.path.join(save_dir, model_file)):
+            parent = os.path.dirname(os.path.abspath(save_dir))
+            os.makedirs(parent, exist_ok=True)
+            with open(f"{save_dir}.lock", 'w') as lock:
+                # Serializes concurrent workers; the later ones find the finished export
+                try:
+                    import fcntl
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                except ImportError:
+                    pass  # no flock on Windows: workers may export twice, but the rename keeps it whole
+                if not os.path.exists(os.path.join(save_dir, model_file)):
+                    print(f"Exporting {model_name} to int8 ONNX in {save_dir}...")
+                    tmp_dir = tempfile.mkdtemp(prefix=".int8-export-", dir=parent)
+                    try:
+                        onnx_model = ORTModelForCausalLM.from_pretrained(model_name, export=True)
+                        quantizer = ORTQuantizer.from_pretrained(onnx_model)
+                        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+                        quantizer.quantize(save_dir=tmp_dir, quantization_config=qconfig)
+                        # Leftovers of an export interrupted before this fix would block the rename
+                        shutil.rmtree(save_dir, ignore_errors=True)
+                        os.replace(tmp_dir, save_dir)
+                    except BaseException:
+                        shutil.rmtree(tmp_dir, ignore_errors=True)
+                        raise
+        return ORTModelForCausalLM.from_pretrained(save_dir, file_name=model_file)
+
+    def _warmup(self):
+        """Pays the one-off compilation cost at startup instead of on the first request"""
+        inputs = self.tokenizer("warmup", return_tensors="pt").to(self.device)
+        with torch.inference_mode():
+            self.model.generate(**inputs, **self.generation_config)
+
+    def _encode(self, text):
+        return torch.tensor(self.tokenizer(text).input_ids, dtype=torch.long)
+
+    def generate_response(self, query, context_ids_list):
+        return self.generate_batch([self.build_input_ids(query, context_ids_list)])[0]
+
+    def build_input_ids(self, query, context_ids_list):
+        """Builds the prompt from a query (text or token IDs) and pre-tokenized context
+        chunks, filling the context until the prompt would exceed the model's length limit"""
+        query_ids = torch.as_tensor(
+            tokenize_text(self.tokenizer, [query])[0] if isinstance(query, str) else query, dtype=torch.long
+        )
+        budget = (self.max_model_length - self.generation_config["max_new_tokens"]
+                  - len(self.prompt_prefix_ids) - len(self.prompt_suffix_ids) - len(self.answer_ids))
+        # Clamped so one over-long question cannot push a whole batch past the length limit
+        if len(query_ids) > budget:
+            print(f"Truncating query from {len(query_ids)} to {budget} tokens")
+            query_ids = query_ids[:budget]
+        budget -= len(query_ids)
+        
+        context = []
+        for chunk_ids in context_ids_list:
+            if context:
+                budget -= len(self.separator_ids)
+                context.append(self.separator_ids)
+            chunk_ids = torch.as_tensor(chunk_ids, dtype=torch.long)
+            if len(chunk_ids) > budget:
+                print(f"Truncating context chunk from {len(chunk_ids)} to {max(budget, 0)} tokens")
+                context.append(chunk_ids[:max(budget, 0)])
+                break
+            context.append(chunk_ids)
+            budget -= len(chunk_ids)
+        
+        return torch.cat([self.prompt_prefix_ids, *context, self.prompt_suffix_ids, query_ids, self.answer_ids])
+
+    def generate_batch(self, input_ids_list):
+        """Runs one generate() call over several prompts, left-padded to a common length.
+        The pad token is EOS and repetition_penalty/no_repeat_ngram_size look at the padded
+        input_ids, so an answer can differ slightly depending on which prompts share its batch"""
+        max_len = max(len(ids) for ids in input_ids_list)
+        input_ids = torch.full((len(input_ids_list), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, ids in enumerate(input_ids_list):
+            input_ids[row, max_len - len(ids):] = ids
+            attention_mask[row, max_len - len(ids):] = 1
         
         try:
-            outputs = self.generator(
-                prompt,
-                **self.generation_config
-            )
-            full_response = outputs[0]['generated_text']
-            answer = full_response.split("Answer:")[1].strip()
-            #return full_text.replace(prompt, "").strip().split("\n")[0]
-            if answer.lower().startswith(("the question is", "the word", "what does")):
-                return "I don't know"  
-            return answer
+            with torch.inference_mode():
+                output = self.model.generate(
+                    input_ids.to(self.device),
+                    attention_mask=attention_mask.to(self.device),
+                    **self.generation_config
+                )
+            # generate() echoes the prompt; everything past the input width is the answer
+            generated = output[:, input_ids.shape[1]:]
+            return [self._clean_answer(self.tokenizer.decode(seq, skip_special_tokens=True)) for seq in generated]
         except Exception as e:
             print(f"Generation error: {str(e)}")
-            return "I couldn't generate a response. Please try a more specific question."
+            return [self.FALLBACK_ANSWER] * len(input_ids_list)
 
-    def _build_prompt(self, query, context):
-        """Builds a prompt that fits within model limits"""
-        base_prompt = f"\n\nQuestion: {query}\n\nAnswer:"
-        max_context_length = self.max_model_length - len(self.tokenizer.tokenize(base_prompt))
-        
-        context_tokens = self.tokenizer.tokenize(context)
-        if len(context_tokens) > max_context_length:
-            print(f"Truncating context from {len(context_tokens)} to {max_context_length} tokens")
-            context_tokens = context_tokens[:max_context_length]
-        
-        truncated_context = self.tokenizer.convert_tokens_to_string(context_tokens)
-        return f"Context: {truncated_context}{base_prompt}"
+    @staticmethod
+    def _clean_answer(text):
+        answer = text.strip()
+        if answer.lower().startswith(("the question is", "the word", "what does")):
+            return "I don't know"  
+        return answer
+
+class GenerationBatcher:
+    """Coalesces concurrent requests arriving within max_wait seconds into one
+    batched generate() call on a background thread"""
+    def __init__(self, rag, max_batch=8, max_wait=0.015):
+        self.rag = rag
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, query, context_ids_list):
+        """Queues a query and returns a Future resolving to its answer"""
+        future = Future()
+        # Prompt assembly runs on the caller's thread; only generation is serialized
+        self.requests.put((self.rag.build_input_ids(query, context_ids_list), future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            
+            try:
+                answers = self.rag.generate_batch([input_ids for input_ids, _ in batch])
+                for (_, future), answer in zip(batch, answers):
+                    future.set_result(answer)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
 
 class VectorStore:
-    def __init__(self, tokenizer=None):
-        self.embeddings = None
+    CACHE_VERSION = 2  # bump when the saved layout or chunk tokenization changes
+
+    def __init__(self, tokenizer=None, k=3, nlist=100, nprobe=8):
         self.texts = None
-        self.nn = NearestNeighbors(n_neighbors=3, metric='cosine')
+        self.chunk_token_ids = None
+        self.chunk_token_counts = None
+        self.index = None
+        self.k = k
+        self.nlist = nlist      # Voronoi cells of the IVF index
+        self.nprobe = nprobe    # cells scanned per query (recall vs latency)
         self.tokenizer = tokenizer  
 
+    def _build_index(self, embeddings):
+        n, d = embeddings.shape
+        # SQ8 stores one byte per dimension and dequantizes inside FAISS's SIMD distance kernels
+        if n < self.nlist * 39:
+            # Too few points to train IVF centroids, so every code is scanned exactly
+            index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.index_factory(d, f"IVF{self.nlist},SQ8", faiss.METRIC_INNER_PRODUCT)
+            index.nprobe = self.nprobe
+        index.train(embeddings)
+        index.add(embeddings)
+        return index
+
     def store(self, embeddings, texts):
-        self.embeddings = np.array(embeddings)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        # Inner product on unit vectors == cosine similarity
+        embeddings = np.ascontiguousarray(embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True))
         self.texts = texts
-        self.nn.fit(self.embeddings)
+        self.index = self._build_index(embeddings)
+        if self.tokenizer:
+            # Token counts are fixed per chunk, so tokenize once here rather than per query
+            self._set_token_ids(tokenize_text(self.tokenizer, texts))
 
-    def search(self, query_embedding, max_tokens=500):
-        distances, indices = self.nn.kneighbors([query_embedding])
+    def _set_token_ids(self, token_ids):
+        self.chunk_token_ids = [np.asarray(ids, dtype=np.int64) for ids in token_ids]
+        self.chunk_token_counts = np.fromiter(
+            (len(ids) for ids in self.chunk_token_ids), dtype=np.int32, count=len(self.chunk_token_ids)
+        )
+
+    def save(self, directory):
+        """Writes into a sibling temp directory and renames it into place, so
+        concurrent workers never see or produce a half-written cache entry"""
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".index-", dir=parent)
+        try:
+            faiss.write_index(self.index, os.path.join(tmp_dir, "faiss.index"))
+            with open(os.path.join(tmp_dir, "chunks.json"), 'w') as file:
+                json.dump({
+                    "texts": self.texts,
+                    "token_ids": None if self.chunk_token_ids is None else [ids.tolist() for ids in self.chunk_token_ids]
+                }, file)
+            try:
+                os.replace(tmp_dir, directory)
+            except OSError:
+                pass  # another worker already saved this entry; keep theirs
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def load(self, directory):
+        """Restores a saved index; returns False if the directory holds no readable cache"""
+        if not os.path.isdir(directory):
+            return False
+        try:
+            with open(os.path.join(directory, "chunks.json")) as file:
+                data = json.load(file)
+            texts, token_ids = data["texts"], data["token_ids"]
+            index = faiss.read_index(os.path.join(directory, "faiss.index"))
+        except (OSError, ValueError, KeyError, TypeError, RuntimeError):
+            # Broken entry (e.g. left by an interrupted write): drop it so save() can replace it
+            shutil.rmtree(directory, ignore_errors=True)
+            return False
+        self.texts, self.index = texts, index
+        if hasattr(self.index, "nprobe"):
+            self.index.nprobe = self.nprobe
+        if self.tokenizer:
+            if token_ids is None:
+                token_ids = tokenize_text(self.tokenizer, self.texts)
+            self._set_token_ids(token_ids)
+        return True
+
+    def _nearest(self, query):
+        _, indices = self.index.search(query[None, :], self.k)
+        return indices[0][indices[0] >= 0]  # FAISS pads missing hits with -1
+
+    def search(self, query_embedding, max_tokens=500, with_token_ids=False):
+        """Returns the nearest chunks within max_tokens; with_token_ids yields
+        (chunk, token_ids) pairs so callers can skip re-tokenizing them"""
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+        hits = self._nearest(query)
         
         if not self.tokenizer:
-            return [self.texts[i] for i in indices[0][:3]]  
+            return [self.texts[i] for i in hits]  
             
         selected_chunks = []
         current_length = 0
         
-        for i in indices[0]:
+        for i in hits:
             chunk = self.texts[i]
-            chunk_length = len(self.tokenizer.tokenize(chunk))
+            chunk_length = int(self.chunk_token_counts[i])
             if current_length + chunk_length > max_tokens:
                 break
-            selected_chunks.append(chunk)
+            selected_chunks.append((chunk, self.chunk_token_ids[i]) if with_token_ids else chunk)
             current_length += chunk_length
         
         return selected_chunks
@@ -153,21 +422,20 @@ def main():
         embedder = EmbeddingGenerator()
         embeddings = embedder.generate(chunks)
         
-        vector_store = VectorStore()
-        vector_store.store(embeddings, chunks)
-        
         rag = RAGPipeline()
         
+        vector_store = VectorStore(tokenizer=rag.tokenizer)
+        vector_store.store(embeddings, chunks)
+        
         while True:
             query = input("Enter your question (or 'quit' to exit): ")
             if query.lower() == 'quit':
                 break
             
             query_embedding = embedder.generate([query])[0]
-            relevant_chunks = vector_store.search(query_embedding)
-            context = "\n".join(relevant_chunks)
+            relevant_chunks = vector_store.search(query_embedding, with_token_ids=True)
             
-            response = rag.generate_response(query, context)
+            response = rag.generate_response(query, [ids for _, ids in relevant_chunks])
             print(f"Answer: {response}\n")
             
     except Exception as e:
@@ -0,0 +1,7 @@
+"""WSGI entry point for production servers, e.g.
+
+    gunicorn -k gthread -w 2 --threads 4 --timeout 120 wsgi:app
+"""
+from app import app
+
+__all__ = ["app"]